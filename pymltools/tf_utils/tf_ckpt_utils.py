@@ -5,6 +5,7 @@ import glob
 import logging
 
 import os
+import re
 import shutil
 import tensorflow as tf
 
@@ -104,4 +105,42 @@ def tf_export_checkpoint(src_ckpt_dir: str, target_ckpt_dir: str):
     shutil.copy(os.path.join(src_ckpt_dir, "checkpoint"), os.path.join(target_ckpt_dir, "checkpoint"))
 
 
-__all__ = ("remove_old_checkpoint_file", "get_last_meta_path", "get_saver_and_last_step", "tf_export_checkpoint")
+def tf_strip_optimizer_slots(src_ckpt_dir: str, target_ckpt_dir: str,
+                             exclude_pattern: str = r"(^|/)(Adam(_\d+)?|beta1_power|beta2_power|masked_adam_step)$"):
+    """
+        copy latest checkpoint without optimizer variables, Adam m / v slots take 2/3 of model size
+    Args:
+        src_ckpt_dir: str, dir of source checkpoint
+        target_ckpt_dir: str, dir to save stripped checkpoint
+        exclude_pattern: str, regex of variable names to drop, default match Adam slots, beta power and
+                         step counter of MaskedAdamOptimizer
+
+    Returns:
+        str: path of stripped checkpoint
+    """
+    if not os.path.exists(target_ckpt_dir):
+        os.mkdir(target_ckpt_dir)
+
+    ckpt = tf.train.latest_checkpoint(src_ckpt_dir)
+    if ckpt is None:
+        raise ValueError("no checkpoint found in {}".format(src_ckpt_dir))
+
+    reader = tf.train.NewCheckpointReader(ckpt)
+    var_to_shape_map = reader.get_variable_to_shape_map()
+    var_to_dtype_map = reader.get_variable_to_dtype_map()
+    keep_name_list = [name for name in sorted(var_to_shape_map.keys()) if not re.search(exclude_pattern, name)]
+    logging.info("keep {} of {} variables in {}".format(len(keep_name_list), len(var_to_shape_map), ckpt))
+
+    with tf.Graph().as_default():
+        var_dict = {name: tf.get_variable(name, shape=var_to_shape_map[name], dtype=var_to_dtype_map[name],
+                                          initializer=tf.zeros_initializer(), trainable=False)
+                    for name in keep_name_list}
+        saver = tf.train.Saver(var_list=var_dict)
+        with tf.Session() as sess:
+            for name, var in var_dict.items():
+                var.load(reader.get_tensor(name), sess)
+            return saver.save(sess, os.path.join(target_ckpt_dir, os.path.basename(ckpt)), write_meta_graph=False)
+
+
+__all__ = ("remove_old_checkpoint_file", "get_last_meta_path", "get_saver_and_last_step", "tf_export_checkpoint",
+           "tf_strip_optimizer_slots")
@@ -1,21 +1,136 @@
 # -*- coding:utf-8 -*-
 from __future__ import absolute_import
 
+import contextlib
 import logging
 
 import tensorflow as tf
 
 from .project_demo import OptimizerType
-from .triplet_loss import batch_hard_triplet_loss
+from .tf_optimizer import allgather_sparse_gradients
+from .triplet_loss import batch_hard_triplet_loss_from_dot_product
 
 End_Point_Prediction_Key = "prediction_keys"
 Prediction_Key_Class = "class"
 Prediction_Key_Prob = "prob"
 
 
+@contextlib.contextmanager
+def _jit_scope(use_xla: bool):
+    """ XLA jit compile ops built in this scope; optimizer ops(sparse scatter) should be built outside """
+    if use_xla:
+        with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True):
+            yield
+    else:
+        yield
+
+
+def _call_network(network, use_bfloat16: bool, features, **kwargs):
+    """
+        call network; with use_bfloat16, float32 features are cast to bfloat16 and the network is built in
+        bfloat16 scope(variables are kept in float32), output and end point predictions are cast back to float32
+    Returns:
+        tuple: (output, end_points)
+    """
+    if not use_bfloat16:
+        return network(features=features, **kwargs)
+
+    def _cast(tensor):
+        return tf.cast(tensor, tf.bfloat16) if tensor.dtype == tf.float32 else tensor
+
+    if isinstance(features, dict):
+        features = {key: _cast(value) for key, value in features.items()}
+    else:
+        features = _cast(features)
+
+    with tf.contrib.tpu.bfloat16_scope():
+        output, end_points = network(features=features, **kwargs)
+
+    # end point predictions go to predictions / export outputs, which are float32 as well
+    if End_Point_Prediction_Key in end_points:
+        end_points = dict(end_points)
+        end_points[End_Point_Prediction_Key] = {
+            key: tf.cast(value, tf.float32) if value.dtype == tf.bfloat16 else value
+            for key, value in end_points[End_Point_Prediction_Key].items()
+        }
+    return tf.cast(output, tf.float32), end_points
+
+
+def _make_optimizer(optimizer_type: OptimizerType, learning_rate):
+    """
+
+    Args:
+        optimizer_type: OptimizerType
+        learning_rate: float or Tensor, built once per model_func call and named "learning_rate"
+
+    Returns:
+        tf.train.Optimizer
+    """
+    learning_rate = tf.identity(learning_rate, name="learning_rate")
+    if optimizer_type == OptimizerType.sgd:
+        return tf.train.GradientDescentOptimizer(learning_rate=learning_rate)
+    return tf.train.AdamOptimizer(learning_rate=learning_rate)
+
+
+def _make_train_op(optimizer, loss, logger=logging, use_horovod: bool = False, horovod_sparse_as_dense: bool = False):
+    """
+
+    Args:
+        optimizer: tf.train.Optimizer
+        loss: Tensor
+        logger: logging.Logger
+        use_horovod: bool, whether to average gradients over horovod workers
+        horovod_sparse_as_dense: bool, allreduce sparse gradients as dense tensors instead of allgather
+
+    Returns:
+        Operation: train op, run after update ops(batch norm need this)
+    """
+    # global step increment is a host side counter, keep it on cpu if it is created here
+    with tf.device("/cpu:0"):
+        global_step = tf.train.get_or_create_global_step()
+
+    update_op_list = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    logger.debug("update ops: {}".format(update_op_list))
+    with tf.control_dependencies(update_op_list):
+        grads_and_vars = optimizer.compute_gradients(loss)
+        if use_horovod:
+            grads_and_vars = allgather_sparse_gradients(grads_and_vars, sparse_as_dense=horovod_sparse_as_dense)
+        return optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+
+
+def _make_export_outputs(predictions: dict, head_key_list=()) -> dict:
+    """ serving signature for SavedModel export; optimizer slots are not part of the PREDICT graph
+
+    Args:
+        predictions: dict, outputs of default signature
+        head_key_list: keys of predictions, each one is also exported as a signature with a single output
+
+    Returns:
+        dict: export outputs
+    """
+    export_outputs = {
+        tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY:
+            tf.estimator.export.PredictOutput(predictions)
+    }
+    for key in head_key_list:
+        export_outputs[key] = tf.estimator.export.PredictOutput({key: predictions[key]})
+    return export_outputs
+
+
+def _accuracy_metric(labels, logits):
+    """
+        top 1 accuracy by tf.nn.in_top_k, no argmax over all classes. Differs from
+        tf.metrics.accuracy(labels, tf.argmax(logits, 1)) in that ties with the max logit count as correct,
+        and rows with non-finite logits count as wrong. labels must be int32 already.
+    """
+    return tf.metrics.mean(tf.cast(tf.nn.in_top_k(tf.cast(logits, tf.float32), labels, 1), tf.float32))
+
+
 def tf_triplet_loss_model_fn(network, scope_name: str, features_embedding_key: str, features_filename_key: str,
                              get_learning_rate_func, optimizer_type: OptimizerType = OptimizerType.adam,
-                             logger=logging, use_l2_normalize: bool = False):
+                             logger=logging, use_l2_normalize: bool = False, use_xla: bool = False,
+                             use_horovod: bool = False, horovod_sparse_as_dense: bool = False,
+                             use_bfloat16: bool = False):
     """
 
     Args:
@@ -27,45 +142,54 @@ def tf_triplet_loss_model_fn(network, scope_name: str, features_embedding_key: s
         optimizer_type: OptimizerType
         logger: logging.Logger
         use_l2_normalize: bool, whether to use l2 before embeddings. Facenet use this.
+        use_xla: bool, whether to jit compile network and triplet loss by XLA
+        use_horovod: bool, whether to average gradients over horovod workers, sparse gradients by allgather
+        horovod_sparse_as_dense: bool, with use_horovod, allreduce sparse gradients as dense tensors
+        use_bfloat16: bool, whether to run network in bfloat16, variables and loss are kept in float32
 
     Returns:
         func: model fn for estimator
     """
 
     def model_func(features, labels, mode, params):
+        # triplet loss only compares labels for equality, int32 labels are kept as they are for it;
+        # network always gets int64 labels
+        loss_labels = labels
         if labels is not None:
+            if labels.dtype not in (tf.int32, tf.int64):
+                loss_labels = tf.cast(labels, tf.int64)
             labels = tf.cast(labels, tf.int64)
 
-        if mode == tf.estimator.ModeKeys.TRAIN:
-            embeddings, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                             is_training=True)
-        else:
-            embeddings, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                             is_training=False)
-
-        embedding_mean_norm = tf.reduce_mean(tf.norm(embeddings, axis=1))
+        is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+        with _jit_scope(use_xla):
+            embeddings, end_points = _call_network(network, use_bfloat16, scope_name=scope_name, features=features,
+                                                   params=params, labels=labels, is_training=is_training)
+
+            # √ axis = 0: means normalize each dim by info from this batch
+            # √ axis = 1: means normalize x each dim only by x info ; 单位向量
+            # google facenet use tf.nn.l2_normalize(embeddings, axis=1) in papers
+            # 1) 单位向量, margin, 无法容纳足够多的聚类中心
+            # 2) github项目, 没有使用单位向量
+            if mode == tf.estimator.ModeKeys.PREDICT:
+                predictions = {
+                    features_embedding_key: tf.nn.l2_normalize(embeddings, axis=1) if use_l2_normalize else embeddings,
+                    features_filename_key: features[features_filename_key]
+                }
+                if End_Point_Prediction_Key in end_points:
+                    predictions.update(end_points[End_Point_Prediction_Key])
+                return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions,
+                                                  export_outputs=_make_export_outputs(predictions))
+
+            dot_product = tf.matmul(embeddings, embeddings, transpose_b=True)
+
+            # embedding_mean_norm is measured before l2 normalize, squared norms are the diagonal of dot product
+            embedding_mean_norm = tf.reduce_mean(tf.sqrt(tf.diag_part(dot_product)))
+
+            # Define triplet loss, l2 normalize is done inside the pairwise distances
+            loss = batch_hard_triplet_loss_from_dot_product(loss_labels, dot_product, margin=params.margin,
+                                                            squared=False, normalize=use_l2_normalize)
         tf.summary.scalar("embedding_mean_norm", embedding_mean_norm)
 
-        # √ axis = 0: means normalize each dim by info from this batch
-        # √ axis = 1: means normalize x each dim only by x info ; 单位向量
-        # todo google facenet use tf.nn.l2_normalize(embeddings, axis=1) in papers
-        # 1) 单位向量, margin, 无法容纳足够多的聚类中心
-        # 2) github项目, 没有使用单位向量
-        if use_l2_normalize:
-            embeddings = tf.nn.l2_normalize(embeddings, axis=0)  # todo 不合理
-
-        if mode == tf.estimator.ModeKeys.PREDICT:
-            predictions = {
-                features_embedding_key: embeddings,
-                features_filename_key: features[features_filename_key]
-            }
-            if End_Point_Prediction_Key in end_points:
-                predictions.update(end_points[End_Point_Prediction_Key])
-            return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
-
-        # Define triplet loss
-        loss = batch_hard_triplet_loss(labels, embeddings, margin=params.margin, squared=False)
-
         with tf.variable_scope("metrics"):
             eval_metric_ops = {"embedding_mean_norm": tf.metrics.mean(embedding_mean_norm)}
 
@@ -76,20 +200,11 @@ def tf_triplet_loss_model_fn(network, scope_name: str, features_embedding_key: s
         tf.summary.scalar('loss', loss)
 
         # Define training step that minimizes the loss with the Adam optimizer
-        if optimizer_type == OptimizerType.sgd:
-            optimizer = tf.train.GradientDescentOptimizer(learning_rate=get_learning_rate_func())
-        else:
-            optimizer = tf.train.AdamOptimizer(learning_rate=get_learning_rate_func())
+        optimizer = _make_optimizer(optimizer_type, get_learning_rate_func())
 
         # train op
-        update_op_list = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        logger.debug("update ops: {}".format(update_op_list))
-        if update_op_list:
-            # batch norm need this code:
-            with tf.control_dependencies(update_op_list):
-                train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
-        else:
-            train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
+        train_op = _make_train_op(optimizer, loss, logger=logger, use_horovod=use_horovod,
+                                  horovod_sparse_as_dense=horovod_sparse_as_dense)
 
         return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op)
 
@@ -97,7 +212,9 @@ def tf_triplet_loss_model_fn(network, scope_name: str, features_embedding_key: s
 
 
 def tf_softmax_model_fn(network, scope_name: str, get_learning_rate_func, features_filename_key: str = None,
-                        optimizer_type: OptimizerType = OptimizerType.adam, logger=logging):
+                        optimizer_type: OptimizerType = OptimizerType.adam, logger=logging, use_xla: bool = False,
+                        use_horovod: bool = False, horovod_sparse_as_dense: bool = False,
+                        use_bfloat16: bool = False):
     """
 
     Args:
@@ -107,62 +224,60 @@ def tf_softmax_model_fn(network, scope_name: str, get_learning_rate_func, featur
         get_learning_rate_func: func, get learning rate
         optimizer_type: OptimizerType
         logger: logging.Logger
+        use_xla: bool, whether to jit compile network and softmax loss by XLA
+        use_horovod: bool, whether to average gradients over horovod workers, sparse gradients by allgather
+        horovod_sparse_as_dense: bool, with use_horovod, allreduce sparse gradients as dense tensors
+        use_bfloat16: bool, whether to run network in bfloat16, variables and loss are kept in float32
 
     Returns:
         func: model fn for estimator
     """
 
     def model_func(features, labels, mode, params):
+        # in_top_k takes int32 targets: cast the raw labels once for it, not back from the int64 network labels
+        metric_labels = labels
         if labels is not None:
+            if labels.dtype != tf.int32:
+                metric_labels = tf.cast(labels, tf.int32)
             labels = tf.cast(labels, tf.int64)
 
-        if mode == tf.estimator.ModeKeys.TRAIN:
-            logits, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                         is_training=True)
-        else:
-            logits, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                         is_training=False)
+        is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+        with _jit_scope(use_xla):
+            logits, end_points = _call_network(network, use_bfloat16, scope_name=scope_name, features=features,
+                                               params=params, labels=labels, is_training=is_training)
 
-        predicted_classes = tf.argmax(logits, 1)
-        if mode == tf.estimator.ModeKeys.PREDICT:
-            predictions = {
-                Prediction_Key_Class: predicted_classes,
-                Prediction_Key_Prob: tf.nn.softmax(logits),
-            }
-            if features_filename_key:
-                predictions[features_filename_key] = features[features_filename_key]
+            if mode == tf.estimator.ModeKeys.PREDICT:
+                predictions = {
+                    Prediction_Key_Class: tf.argmax(logits, 1),
+                    Prediction_Key_Prob: tf.nn.softmax(logits),
+                }
+                if features_filename_key:
+                    predictions[features_filename_key] = features[features_filename_key]
 
-            if End_Point_Prediction_Key in end_points:
-                predictions.update(end_points[End_Point_Prediction_Key])
-            return tf.estimator.EstimatorSpec(mode, predictions=predictions)
+                if End_Point_Prediction_Key in end_points:
+                    predictions.update(end_points[End_Point_Prediction_Key])
+                return tf.estimator.EstimatorSpec(
+                    mode, predictions=predictions,
+                    export_outputs=_make_export_outputs(predictions, (Prediction_Key_Class, Prediction_Key_Prob)))
 
-        # Compute loss.
-        loss = tf.losses.sparse_softmax_cross_entropy(labels=labels, logits=logits)
+            # Compute loss.
+            loss = tf.losses.sparse_softmax_cross_entropy(labels=labels, logits=logits)
 
         # Create training op.
         if mode == tf.estimator.ModeKeys.TRAIN:
             tf.summary.scalar('loss', loss)
 
             # Define training step that minimizes the loss with the Adam optimizer
-            if optimizer_type == OptimizerType.sgd:
-                optimizer = tf.train.GradientDescentOptimizer(learning_rate=get_learning_rate_func())
-            else:
-                optimizer = tf.train.AdamOptimizer(learning_rate=get_learning_rate_func())
+            optimizer = _make_optimizer(optimizer_type, get_learning_rate_func())
 
             # train op
-            update_op_list = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-            logger.debug("update ops: {}".format(update_op_list))
-            if update_op_list:
-                # batch norm need this code:
-                with tf.control_dependencies(update_op_list):
-                    train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
-            else:
-                train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
+            train_op = _make_train_op(optimizer, loss, logger=logger, use_horovod=use_horovod,
+                                      horovod_sparse_as_dense=horovod_sparse_as_dense)
 
             return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op, scaffold=None)
 
         # Compute evaluation metrics.
-        eval_metric_ops = {'accuracy': tf.metrics.accuracy(labels=labels, predictions=predicted_classes)}
+        eval_metric_ops = {'accuracy': _accuracy_metric(labels=metric_labels, logits=logits)}
         return tf.estimator.EstimatorSpec(mode, loss=loss, eval_metric_ops=eval_metric_ops)
 
     return model_func
@@ -185,51 +300,43 @@ def tf_margin_base_softmax_model_fn(network, loss_fn, scope_name: str, get_learn
     """
 
     def model_func(features, labels, mode, params):
+        # in_top_k takes int32 targets: cast the raw labels once for it, not back from the int64 network labels
+        metric_labels = labels
         if labels is not None:
+            if labels.dtype != tf.int32:
+                metric_labels = tf.cast(labels, tf.int32)
             labels = tf.cast(labels, tf.int64)
 
-        if mode == tf.estimator.ModeKeys.TRAIN:
-            embeddings, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                             is_training=True)
-        else:
-            embeddings, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
-                                             is_training=False)
+        is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+        embeddings, end_points = network(scope_name=scope_name, features=features, params=params, labels=labels,
+                                         is_training=is_training)
 
         logits, loss = loss_fn(embeddings=embeddings, labels=labels, )
-        predicted_classes = tf.argmax(logits, 1)
         if mode == tf.estimator.ModeKeys.PREDICT:
             predictions = {
-                Prediction_Key_Class: predicted_classes,
+                Prediction_Key_Class: tf.argmax(logits, 1),
                 Prediction_Key_Prob: tf.nn.softmax(logits),
             }
             if End_Point_Prediction_Key in end_points:
                 predictions.update(end_points[End_Point_Prediction_Key])
-            return tf.estimator.EstimatorSpec(mode, predictions=predictions)
+            return tf.estimator.EstimatorSpec(
+                mode, predictions=predictions,
+                export_outputs=_make_export_outputs(predictions, (Prediction_Key_Class, Prediction_Key_Prob)))
 
         # Create training op.
         if mode == tf.estimator.ModeKeys.TRAIN:
             tf.summary.scalar('loss', loss)
 
             # Define training step that minimizes the loss with the Adam optimizer
-            if optimizer_type == OptimizerType.sgd:
-                optimizer = tf.train.GradientDescentOptimizer(learning_rate=get_learning_rate_func())
-            else:
-                optimizer = tf.train.AdamOptimizer(learning_rate=get_learning_rate_func())
+            optimizer = _make_optimizer(optimizer_type, get_learning_rate_func())
 
             # train op
-            update_op_list = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-            logger.debug("update ops: {}".format(update_op_list))
-            if update_op_list:
-                # batch norm need this code:
-                with tf.control_dependencies(update_op_list):
-                    train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
-            else:
-                train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
+            train_op = _make_train_op(optimizer, loss, logger=logger)
 
             return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op, scaffold=None)
 
         # Compute evaluation metrics.
-        eval_metric_ops = {'accuracy': tf.metrics.accuracy(labels=labels, predictions=predicted_classes)}
+        eval_metric_ops = {'accuracy': _accuracy_metric(labels=metric_labels, logits=logits)}
         return tf.estimator.EstimatorSpec(mode, loss=loss, eval_metric_ops=eval_metric_ops)
 
     return model_func
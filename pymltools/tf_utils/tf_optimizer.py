@@ -1,8 +1,10 @@
 # -*- coding:utf-8 -*-
 from __future__ import absolute_import
 
-from tensorflow.python.framework import ops
-from tensorflow.python.ops import array_ops, control_flow_ops, math_ops, state_ops
+import numpy as np
+from tensorflow.python.eager import context
+from tensorflow.python.framework import dtypes, ops
+from tensorflow.python.ops import array_ops, control_flow_ops, init_ops, math_ops, resource_variable_ops, state_ops
 from tensorflow.python.training import adam
 
 
@@ -11,35 +13,168 @@ class MaskedAdamOptimizer(adam.AdamOptimizer):
         Author: 欧泽彬
         ref: https://www.zhihu.com/question/265357659/answer/580469438
         暂未验证
+
+        Sparse gradients only touch the rows in `indices`: m / v slices are gathered once,
+        updated, and written back by `scatter_update`, so no full-size slot write happens per step.
+        Rows skipped by earlier steps are decayed by beta ** (step - last_step) when touched again,
+        which keeps m / v equal to the moments of dense Adam. var is intentionally only updated on the rows in
+        `indices`, while dense Adam also moves every other row with nonzero m.
+
+        sparse_as_dense_threshold: sparse gradients of variables with fewer rows than this are converted to dense
+        tensors, and updated by the single fused dense Adam kernel(every row is updated then). 0 means never.
+        unique_indices: set it when sparse gradients never have duplicated indices(e.g. after tf.unique), then
+        the dedup is skipped and the variable is also written by `scatter_update` instead of atomic `scatter_add`.
     """
 
-    def _apply_sparse_shared(self, grad, var, indices, scatter_add):
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8, use_locking=False, name="Adam",
+                 sparse_as_dense_threshold: int = 0, unique_indices: bool = False):
+        super(MaskedAdamOptimizer, self).__init__(learning_rate=learning_rate, beta1=beta1, beta2=beta2,
+                                                  epsilon=epsilon, use_locking=use_locking, name=name)
+        self._sparse_as_dense_threshold = sparse_as_dense_threshold
+        self._unique_indices = unique_indices
+
+    def _is_small_sparse(self, grad, var) -> bool:
+        if not self._sparse_as_dense_threshold or not isinstance(grad, ops.IndexedSlices):
+            return False
+        num_rows = var.get_shape().as_list()[0]
+        return num_rows is not None and num_rows < self._sparse_as_dense_threshold
+
+    def compute_gradients(self, *args, **kwargs):
+        grads_and_vars = super(MaskedAdamOptimizer, self).compute_gradients(*args, **kwargs)
+        return [(ops.convert_to_tensor(g) if self._is_small_sparse(g, v) else g, v) for g, v in grads_and_vars]
+
+    def _create_slots(self, var_list):
+        # Create the beta1 and beta2 accumulators and the step counter on the same device as the first variable.
+        first_var = min(var_list, key=lambda x: x.name)
+        self._create_non_slot_variable(initial_value=self._beta1, name="beta1_power", colocate_with=first_var)
+        self._create_non_slot_variable(initial_value=self._beta2, name="beta2_power", colocate_with=first_var)
+        self._create_non_slot_variable(initial_value=np.int64(1), name="masked_adam_step", colocate_with=first_var)
+
+        # Create slots for the first and second moments and the last update step, slot_creator colocates them with v.
+        for v in var_list:
+            self._zeros_slot(v, "m", self._name)
+            self._zeros_slot(v, "v", self._name)
+            # step counts are int64: float / half precision stops counting exactly after 2^24 / 2048 steps
+            self._get_or_make_slot_with_initializer(v, init_ops.zeros_initializer(), v.get_shape()[:1],
+                                                    dtypes.int64, "last_step", self._name)
+
+    def _get_step_accumulator(self):
+        with ops.init_scope():
+            if context.executing_eagerly():
+                graph = None
+            else:
+                graph = ops.get_default_graph()
+            return self._get_non_slot_variable("masked_adam_step", graph=graph)
+
+    def _prepare(self):
+        super(MaskedAdamOptimizer, self)._prepare()
+        # shared by all variables, built once per step instead of once per variable
         beta1_power, beta2_power = self._get_beta_accumulators()
-        beta1_power = math_ops.cast(beta1_power, var.dtype.base_dtype)
-        beta2_power = math_ops.cast(beta2_power, var.dtype.base_dtype)
-        lr_t = math_ops.cast(self._lr_t, var.dtype.base_dtype)
+        self._one_minus_beta1_t = 1 - self._beta1_t
+        self._one_minus_beta2_t = 1 - self._beta2_t
+        self._corrected_lr_t = self._lr_t * math_ops.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+    def _apply_sparse_shared(self, grad, var, indices, scatter_add, scatter_update):
+        # a variable may get no rows in this batch(e.g. frozen sub network), skip all the gather / scatter then
+        return control_flow_ops.cond(
+            math_ops.greater(array_ops.size(indices), 0),
+            lambda: self._apply_sparse_update(grad, var, indices, scatter_add, scatter_update),
+            control_flow_ops.no_op)
+
+    def _apply_sparse_update(self, grad, var, indices, scatter_add, scatter_update):
+        lr = math_ops.cast(self._corrected_lr_t, var.dtype.base_dtype)
         beta1_t = math_ops.cast(self._beta1_t, var.dtype.base_dtype)
         beta2_t = math_ops.cast(self._beta2_t, var.dtype.base_dtype)
+        one_minus_beta1_t = math_ops.cast(self._one_minus_beta1_t, var.dtype.base_dtype)
+        one_minus_beta2_t = math_ops.cast(self._one_minus_beta2_t, var.dtype.base_dtype)
         epsilon_t = math_ops.cast(self._epsilon_t, var.dtype.base_dtype)
-        lr = (lr_t * math_ops.sqrt(1 - beta2_power) / (1 - beta1_power))
-        # m_t = beta1 * m + (1 - beta1) * g_t
+        # steps since each row was last updated, shape (n, 1, ...) to broadcast over grad
+        step = array_ops.identity(self._get_step_accumulator())
+        last_step = self.get_slot(var, "last_step")
+        skipped_steps = array_ops.reshape(math_ops.cast(step - array_ops.gather(last_step, indices),
+                                                        var.dtype.base_dtype),
+                                          [-1] + [1] * (var.get_shape().ndims - 1))
+        # last_step must be read before it is overwritten
+        with ops.control_dependencies([skipped_steps]):
+            last_step_t = scatter_update(last_step, indices, array_ops.fill(array_ops.shape(indices), step))
+        # m_t = beta1 ** skipped_steps * m + (1 - beta1) * g_t
         m = self.get_slot(var, "m")
-        m_scaled_g_values = grad * (1 - beta1_t)
-        m_t = state_ops.assign(m, m * beta1_t,
-                               use_locking=self._use_locking)
-        with ops.control_dependencies([m_t]):
-            m_t = scatter_add(m, indices, m_scaled_g_values)
-        # v_t = beta2 * v + (1 - beta2) * (g_t * g_t)
+        m_t_slice = array_ops.gather(m, indices) * math_ops.pow(beta1_t, skipped_steps) + grad * one_minus_beta1_t
+        m_t = scatter_update(m, indices, m_t_slice)
+        # v_t = beta2 ** skipped_steps * v + (1 - beta2) * (g_t * g_t)
         v = self.get_slot(var, "v")
-        v_scaled_g_values = (grad * grad) * (1 - beta2_t)
-        v_t = state_ops.assign(v, v * beta2_t, use_locking=self._use_locking)
-        with ops.control_dependencies([v_t]):
-            v_t = scatter_add(v, indices, v_scaled_g_values)
-        gather_m_t = array_ops.gather(m_t, indices)
-        gather_v_t = array_ops.gather(v_t, indices)
-        gather_v_sqrt = math_ops.sqrt(gather_v_t)
-        var_update = scatter_add(var, indices, -lr * gather_m_t / (gather_v_sqrt + epsilon_t))
-        return control_flow_ops.group(*[var_update, m_t, v_t])
-
-
-__all__ = ("MaskedAdamOptimizer",)
+        v_t_slice = array_ops.gather(v, indices) * math_ops.pow(beta2_t, skipped_steps) + \
+                    (grad * grad) * one_minus_beta2_t
+        v_t = scatter_update(v, indices, v_t_slice)
+        var_delta = -lr * m_t_slice / (math_ops.sqrt(v_t_slice) + epsilon_t)
+        if self._unique_indices:
+            var_update = scatter_update(var, indices, array_ops.gather(var, indices) + var_delta)
+        else:
+            var_update = scatter_add(var, indices, var_delta)
+        return control_flow_ops.group(*[var_update, m_t, v_t, last_step_t])
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_sparse_shared(
+            grad.values, var, grad.indices,
+            lambda x, i, v: state_ops.scatter_add(x, i, v, use_locking=self._use_locking),
+            lambda x, i, v: state_ops.scatter_update(x, i, v, use_locking=self._use_locking))
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        # raw scatter ops: reading back x.value() would copy the whole slot every step
+        return self._apply_sparse_shared(
+            grad, var, indices,
+            lambda x, i, v: resource_variable_ops.resource_scatter_add(x.handle, i, v),
+            lambda x, i, v: resource_variable_ops.resource_scatter_update(x.handle, i, v))
+
+    def _apply_sparse_duplicate_indices(self, grad, var):
+        if self._unique_indices:
+            return self._apply_sparse(grad, var)
+        return super(MaskedAdamOptimizer, self)._apply_sparse_duplicate_indices(grad, var)
+
+    def _resource_apply_sparse_duplicate_indices(self, grad, var, indices):
+        if self._unique_indices:
+            return self._resource_apply_sparse(grad, var, indices)
+        return super(MaskedAdamOptimizer, self)._resource_apply_sparse_duplicate_indices(grad, var, indices)
+
+    def _finish(self, update_ops, name_scope):
+        # Update the power accumulators and the step counter.
+        with ops.control_dependencies(update_ops):
+            beta1_power, beta2_power = self._get_beta_accumulators()
+            step = self._get_step_accumulator()
+            with ops.colocate_with(beta1_power):
+                update_beta1 = beta1_power.assign(beta1_power * self._beta1_t, use_locking=self._use_locking)
+                update_beta2 = beta2_power.assign(beta2_power * self._beta2_t, use_locking=self._use_locking)
+                update_step = step.assign_add(1, use_locking=self._use_locking)
+        return control_flow_ops.group(*update_ops + [update_beta1, update_beta2, update_step], name=name_scope)
+
+
+def allgather_sparse_gradients(grads_and_vars, sparse_as_dense: bool = False) -> list:
+    """
+        average gradients over horovod workers: sparse gradients by allgather of (indices, values),
+        dense gradients by allreduce. Put it between Optimizer.compute_gradients and Optimizer.apply_gradients.
+    Args:
+        grads_and_vars: list of (gradient, variable)
+        sparse_as_dense: bool, allreduce sparse gradients as dense tensors, faster when they are not really sparse
+
+    Returns:
+        list: list of (averaged gradient, variable)
+    """
+    import horovod.tensorflow as hvd
+
+    result_list = []
+    for grad, var in grads_and_vars:
+        if grad is not None:
+            if isinstance(grad, ops.IndexedSlices):
+                if sparse_as_dense:
+                    grad = hvd.allreduce(ops.convert_to_tensor(grad))
+                else:
+                    grad = ops.IndexedSlices(values=hvd.allgather(grad.values) / hvd.size(),
+                                             indices=hvd.allgather(grad.indices), dense_shape=grad.dense_shape)
+            else:
+                grad = hvd.allreduce(grad)
+        result_list.append((grad, var))
+
+    return result_list
+
+
+__all__ = ("MaskedAdamOptimizer", "allgather_sparse_gradients")
@@ -8,26 +8,50 @@ import tensorflow as tf
 from pyxtools import calc_distance_pairs
 
 
-def _pairwise_distances(embeddings, squared=False):
+def _pairwise_distances(embeddings, squared=False, normalize=False):
     """Compute the 2D matrix of distances between all the embeddings.
 
     Args:
         embeddings: tensor of shape (batch_size, embed_dim)
         squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
                  If false, output is the pairwise euclidean distance matrix.
+        normalize: Boolean. If true, distances are computed between the l2 normalized embeddings,
+                 same as tf.nn.l2_normalize(embeddings, axis=1), without materializing them.
 
     Returns:
         pairwise_distances: tensor of shape (batch_size, batch_size)
     """
     # Get the dot product between all embeddings
     # shape (batch_size, batch_size)
-    dot_product = tf.matmul(embeddings, tf.transpose(embeddings))
+    dot_product = tf.matmul(embeddings, embeddings, transpose_b=True)
 
+    return _pairwise_distances_from_dot_product(dot_product, squared=squared, normalize=normalize)
+
+
+def _pairwise_distances_from_dot_product(dot_product, squared=False, normalize=False):
+    """Compute the 2D matrix of distances from the dot product between all the embeddings.
+
+    Args:
+        dot_product: tensor of shape (batch_size, batch_size), embeddings x transpose(embeddings)
+        squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
+                 If false, output is the pairwise euclidean distance matrix.
+        normalize: Boolean. If true, distances are computed between the l2 normalized embeddings.
+
+    Returns:
+        pairwise_distances: tensor of shape (batch_size, batch_size)
+    """
     # Get squared L2 norm for each embedding. We can just take the diagonal of `dot_product`.
     # This also provides more numerical stability (the diagonal of the result will be exactly 0).
     # shape (batch_size,)
     square_norm = tf.diag_part(dot_product)
 
+    if normalize:
+        # <a / |a|, b / |b|> = <a, b> / (|a| * |b|); epsilon is the one used by tf.nn.l2_normalize
+        inv_norm = tf.rsqrt(tf.maximum(square_norm, 1e-12))
+        dot_product = dot_product * tf.expand_dims(inv_norm, 1) * tf.expand_dims(inv_norm, 0)
+        # take the squared norm from the scaled diagonal again, so the diagonal distance stays exactly 0
+        square_norm = tf.diag_part(dot_product)
+
     # Compute the pairwise distance matrix as we have:
     # ||a - b||^2 = ||a||^2  - 2 <a, b> + ||b||^2
     # shape (batch_size, batch_size)
@@ -175,7 +199,7 @@ def batch_all_triplet_loss(labels, embeddings, margin, squared=False):
     return triplet_loss, fraction_positive_triplets
 
 
-def batch_hard_triplet_loss(labels, embeddings, margin, squared=False):
+def batch_hard_triplet_loss(labels, embeddings, margin, squared=False, normalize=False):
     """Build the triplet loss over a batch of embeddings.
 
     For each anchor, we get the hardest positive and hardest negative to form a triplet.
@@ -186,12 +210,33 @@ def batch_hard_triplet_loss(labels, embeddings, margin, squared=False):
         margin: margin for triplet loss
         squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
                  If false, output is the pairwise euclidean distance matrix.
+        normalize: Boolean. If true, use l2 normalized embeddings(axis=1) for the distances.
+
+    Returns:
+        triplet_loss: scalar tensor containing the triplet loss
+    """
+    dot_product = tf.matmul(embeddings, embeddings, transpose_b=True)
+    return batch_hard_triplet_loss_from_dot_product(labels, dot_product, margin, squared=squared, normalize=normalize)
+
+
+def batch_hard_triplet_loss_from_dot_product(labels, dot_product, margin, squared=False, normalize=False):
+    """Build the batch hard triplet loss from the dot product between all the embeddings.
+
+    Callers which already have embeddings x transpose(embeddings) skip another pass over the embeddings.
+
+    Args:
+        labels: labels of the batch, of size (batch_size,)
+        dot_product: tensor of shape (batch_size, batch_size), embeddings x transpose(embeddings)
+        margin: margin for triplet loss
+        squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
+                 If false, output is the pairwise euclidean distance matrix.
+        normalize: Boolean. If true, use l2 normalized embeddings(axis=1) for the distances.
 
     Returns:
         triplet_loss: scalar tensor containing the triplet loss
     """
     # Get the pairwise distance matrix
-    pairwise_dist = _pairwise_distances(embeddings, squared=squared)
+    pairwise_dist = _pairwise_distances_from_dot_product(dot_product, squared=squared, normalize=normalize)
 
     # For each anchor, get the hardest positive
     # First, we need to get a mask for every valid positive (they should have same label)
@@ -367,4 +412,5 @@ def get_triplet_pair_np(anchor_feature: np.ndarray, all_feature: np.ndarray, all
     return result_list
 
 
-__all__ = ("batch_all_triplet_loss", "get_triplet_pair_np", "batch_hard_triplet_loss", "batch_hard_triplet_loss_v2")
+__all__ = ("batch_all_triplet_loss", "get_triplet_pair_np", "batch_hard_triplet_loss", "batch_hard_triplet_loss_v2",
+           "batch_hard_triplet_loss_from_dot_product")
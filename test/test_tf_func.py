@@ -3,18 +3,26 @@ from __future__ import absolute_import
 
 import logging
 import math
+import sys
+import types
 import unittest
+from unittest import mock
 
 import numpy as np
 import os
 import shutil
+import tempfile
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
 try:
-    from pymltools.tf_utils import init_logger, AbstractEstimator, DatasetUtils, tf_model_fn, OptimizerType
+    from pymltools.tf_utils import init_logger, AbstractEstimator, DatasetUtils, tf_model_fn, OptimizerType, \
+        batch_hard_triplet_loss, batch_hard_triplet_loss_from_dot_product, MaskedAdamOptimizer, \
+        tf_strip_optimizer_slots, allgather_sparse_gradients
 except ImportError:
-    from pymltools.pymltools.tf_utils import init_logger, AbstractEstimator, DatasetUtils, tf_model_fn, OptimizerType
+    from pymltools.pymltools.tf_utils import init_logger, AbstractEstimator, DatasetUtils, tf_model_fn, \
+        OptimizerType, batch_hard_triplet_loss, batch_hard_triplet_loss_from_dot_product, MaskedAdamOptimizer, \
+        tf_strip_optimizer_slots, allgather_sparse_gradients
 
 init_logger(None)
 
@@ -114,6 +122,192 @@ class TestTFFunc(unittest.TestCase):
         for index in range(len(test_array_list)):
             self.assertTrue((abs(np_std_list[index] - tf_std_list[index]) < 1e-3).all())
 
+    def testTripletLossNormalize(self):
+        """
+            batch_hard_triplet_loss(normalize=True) equals loss of tf.nn.l2_normalize(embeddings, axis=1),
+            batch_hard_triplet_loss_from_dot_product equals batch hard loss computed from embeddings by numpy
+        Returns:
+
+        """
+
+        def _get_batch_hard_loss_by_np(arr: np.ndarray, label_arr: np.ndarray, margin: float) -> float:
+            distance = np.sqrt(np.maximum(np.sum(np.square(arr[:, None, :] - arr[None, :, :]), axis=2), 0.0))
+            loss_list = []
+            for i in range(arr.shape[0]):
+                positive_mask = (label_arr == label_arr[i]) & (np.arange(arr.shape[0]) != i)
+                hardest_positive = np.max(distance[i][positive_mask])
+                hardest_negative = np.min(distance[i][label_arr != label_arr[i]])
+                loss_list.append(max(hardest_positive - hardest_negative + margin, 0.0))
+            return float(np.mean(loss_list))
+
+        test_embedding = np.random.random((16, 8)).astype(np.float32) * 10
+        test_label = np.array([i // 4 for i in range(16)], dtype=np.int64)
+        with tf.Graph().as_default() as graph:
+            embedding = tf.constant(test_embedding)
+            label = tf.constant(test_label)
+            fused_loss = batch_hard_triplet_loss(label, embedding, margin=0.5, squared=False, normalize=True)
+            loss = batch_hard_triplet_loss(label, tf.nn.l2_normalize(embedding, axis=1), margin=0.5, squared=False)
+            dot_product_loss = batch_hard_triplet_loss_from_dot_product(
+                label, tf.matmul(embedding, embedding, transpose_b=True), margin=0.5, squared=False, normalize=False)
+            with tf.Session(graph=graph) as sess:
+                fused_loss_value, loss_value, dot_product_loss_value = sess.run([fused_loss, loss, dot_product_loss])
+
+        self.assertTrue(abs(fused_loss_value - loss_value) < 1e-5)
+        np_loss_value = _get_batch_hard_loss_by_np(test_embedding.astype(np.float64), test_label, margin=0.5)
+        self.assertTrue(abs(dot_product_loss_value - np_loss_value) < 1e-3)
+
+    def testMaskedAdamOptimizer(self):
+        """
+            MaskedAdamOptimizer keeps m / v of tf.train.AdamOptimizer on sparse gradients,
+            with skipped rows, duplicated indices and empty batches.
+            var intentionally differs from tf.train.AdamOptimizer, which moves every row with nonzero m on every
+            step; it is compared with a numpy lazy adam which only updates the rows in indices.
+        Returns:
+
+        """
+        num_rows, dim = 6, 3
+        learning_rate, beta1, beta2, epsilon = 0.1, 0.9, 0.999, 1e-8
+        # rows 4, 5 are skipped until the last step, which touches all rows
+        step_indices_list = [[0, 1, 1], [2], [], [0, 3, 3, 3], [], [1, 2], [0, 1, 2, 3, 4, 5]]
+        unique_step_indices_list = [[0, 1], [2], [], [0, 3], [], [1, 2], [0, 1, 2, 3, 4, 5]]
+        init_value = np.random.random((num_rows, dim)).astype(np.float32)
+
+        def _run(optimizer_func, use_resource: bool, indices_list: list, step_values_list: list) -> list:
+            with tf.Graph().as_default() as graph:
+                var = tf.get_variable("embedding", initializer=init_value, use_resource=use_resource)
+                indices = tf.placeholder(dtype=tf.int32, shape=(None,), name="indices")
+                values = tf.placeholder(dtype=tf.float32, shape=(None, dim), name="values")
+                optimizer = optimizer_func()
+                train_op = optimizer.minimize(tf.reduce_sum(tf.gather(var, indices) * values), var_list=[var])
+                with tf.Session(graph=graph) as sess:
+                    sess.run(tf.global_variables_initializer())
+                    for step_indices, step_values in zip(indices_list, step_values_list):
+                        sess.run(train_op, feed_dict={indices: np.array(step_indices, dtype=np.int32),
+                                                      values: step_values})
+                    return sess.run([var, optimizer.get_slot(var, "m"), optimizer.get_slot(var, "v")])
+
+        def _run_lazy_adam_by_np(indices_list: list, step_values_list: list) -> np.ndarray:
+            var = init_value.astype(np.float64)
+            m, v = np.zeros_like(var), np.zeros_like(var)
+            last_step = np.zeros((num_rows,), dtype=np.int64)
+            for step, (step_indices, step_values) in enumerate(zip(indices_list, step_values_list), start=1):
+                grad = {}
+                for index, value in zip(step_indices, step_values.astype(np.float64)):
+                    grad[index] = grad.get(index, 0.0) + value
+                lr = learning_rate * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+                for index, g in grad.items():
+                    skipped_steps = step - last_step[index]
+                    m[index] = beta1 ** skipped_steps * m[index] + (1 - beta1) * g
+                    v[index] = beta2 ** skipped_steps * v[index] + (1 - beta2) * g * g
+                    var[index] -= lr * m[index] / (np.sqrt(v[index]) + epsilon)
+                    last_step[index] = step
+            return var
+
+        def _assert_close(arr1: np.ndarray, arr2: np.ndarray):
+            self.assertTrue((abs(arr1 - arr2) < 1e-5).all())
+
+        for indices_list, optimizer_kwargs in ((step_indices_list, {}),
+                                               (unique_step_indices_list, {"unique_indices": True})):
+            step_values_list = [np.random.random((len(i), dim)).astype(np.float32) for i in indices_list]
+            np_var_value = _run_lazy_adam_by_np(indices_list, step_values_list)
+            for use_resource in (False, True):
+                _, m_value, v_value = _run(lambda: tf.train.AdamOptimizer(learning_rate=learning_rate),
+                                           use_resource, indices_list, step_values_list)
+                masked_var_value, masked_m_value, masked_v_value = _run(
+                    lambda: MaskedAdamOptimizer(learning_rate=learning_rate, **optimizer_kwargs),
+                    use_resource, indices_list, step_values_list)
+                _assert_close(np_var_value, masked_var_value)
+                _assert_close(m_value, masked_m_value)
+                _assert_close(v_value, masked_v_value)
+
+        # small variable: gradients are dense, m / v are the same, var is updated on every row
+        step_values_list = [np.random.random((len(i), dim)).astype(np.float32) for i in step_indices_list]
+        for use_resource in (False, True):
+            _, m_value, v_value = _run(lambda: tf.train.AdamOptimizer(learning_rate=learning_rate),
+                                       use_resource, step_indices_list, step_values_list)
+            _, masked_m_value, masked_v_value = _run(
+                lambda: MaskedAdamOptimizer(learning_rate=learning_rate, sparse_as_dense_threshold=num_rows + 1),
+                use_resource, step_indices_list, step_values_list)
+            _assert_close(m_value, masked_m_value)
+            _assert_close(v_value, masked_v_value)
+
+    def testStripOptimizerSlots(self):
+        """
+            stripped checkpoint only keeps model variables, and model variables can be restored from it
+        Returns:
+
+        """
+        src_ckpt_dir = tempfile.mkdtemp()
+        target_ckpt_dir = os.path.join(src_ckpt_dir, "stripped")
+        try:
+            with tf.Graph().as_default() as graph:
+                global_step = tf.train.get_or_create_global_step()
+                var = tf.get_variable("embedding", initializer=np.random.random((6, 3)).astype(np.float32))
+                indices = tf.constant([0, 2, 2], dtype=tf.int32)
+                train_op = MaskedAdamOptimizer(learning_rate=0.1).minimize(
+                    tf.reduce_sum(tf.gather(var, indices)), global_step=global_step)
+                with tf.Session(graph=graph) as sess:
+                    sess.run(tf.global_variables_initializer())
+                    sess.run(train_op)
+                    var_value = sess.run(var)
+                    tf.train.Saver().save(sess, os.path.join(src_ckpt_dir, "model.ckpt"), global_step=global_step)
+
+            tf_strip_optimizer_slots(src_ckpt_dir, target_ckpt_dir)
+            ckpt = tf.train.latest_checkpoint(target_ckpt_dir)
+            self.assertIsNotNone(ckpt)
+            self.assertEqual(set(tf.train.NewCheckpointReader(ckpt).get_variable_to_shape_map().keys()),
+                             {"embedding", "global_step"})
+
+            with tf.Graph().as_default() as graph:
+                global_step = tf.train.get_or_create_global_step()
+                var = tf.get_variable("embedding", shape=(6, 3), dtype=tf.float32)
+                with tf.Session(graph=graph) as sess:
+                    tf.train.Saver(var_list=[var, global_step]).restore(sess, ckpt)
+                    self.assertTrue((abs(sess.run(var) - var_value) < 1e-6).all())
+                    self.assertEqual(sess.run(global_step), 1)
+        finally:
+            shutil.rmtree(src_ckpt_dir)
+
+    def testAllgatherSparseGradients(self):
+        """
+            sparse gradients are allgathered, dense gradients and sparse_as_dense are allreduced; horovod is stubbed
+        Returns:
+
+        """
+        call_list = []
+        hvd = types.ModuleType("horovod.tensorflow")
+        hvd.size = lambda: 2
+        hvd.allgather = lambda tensor: call_list.append("allgather") or tf.concat([tensor, tensor], axis=0)
+        hvd.allreduce = lambda tensor: call_list.append("allreduce") or tf.identity(tensor)
+        horovod = types.ModuleType("horovod")
+        horovod.tensorflow = hvd
+
+        with tf.Graph().as_default() as graph, \
+                mock.patch.dict(sys.modules, {"horovod": horovod, "horovod.tensorflow": hvd}):
+            var = tf.get_variable("embedding", initializer=np.zeros((4, 2), dtype=np.float32))
+            sparse_grad = tf.IndexedSlices(values=tf.constant([[1.0, 2.0]]), indices=tf.constant([1]),
+                                           dense_shape=tf.constant([4, 2]))
+            dense_grad = tf.ones((4, 2))
+
+            result_list = allgather_sparse_gradients([(sparse_grad, var), (dense_grad, var), (None, var)])
+            self.assertEqual(call_list, ["allgather", "allgather", "allreduce"])
+            self.assertTrue(isinstance(result_list[0][0], tf.IndexedSlices))
+            self.assertIsNone(result_list[2][0])
+
+            call_list.clear()
+            dense_result_list = allgather_sparse_gradients([(sparse_grad, var)], sparse_as_dense=True)
+            self.assertEqual(call_list, ["allreduce"])
+            self.assertFalse(isinstance(dense_result_list[0][0], tf.IndexedSlices))
+
+            with tf.Session(graph=graph) as sess:
+                values, indices, dense_value = sess.run([result_list[0][0].values, result_list[0][0].indices,
+                                                         dense_result_list[0][0]])
+
+        # values of 2 workers are gathered and averaged
+        self.assertTrue((abs(values - np.array([[0.5, 1.0], [0.5, 1.0]])) < 1e-6).all())
+        self.assertEqual(list(indices), [1, 1])
+        self.assertTrue((abs(dense_value - np.array([[0, 0], [1, 2], [0, 0], [0, 0]])) < 1e-6).all())
+
 
 class TestTFGrad(unittest.TestCase):
     def setUp(self):